@@ -0,0 +1,58 @@
+import math
+import numpy as np
+from numba import njit
+
+EARTH_RADIUS_M = 6371000
+
+@njit(cache=True, fastmath=True)
+def filter_kernel(lat, lon, threshold_m):
+    # Fused haversine/bearing: coordinates are converted to radians once, and
+    # sin/cos of the anchor latitude are cached until the anchor moves. An
+    # equirectangular estimate settles most points; the full haversine is
+    # only evaluated when the estimate is within 1% of the threshold. Points
+    # in a stationary dwell already exit at the trig-free estimate, so a
+    # spatial grid pre-check does not pay for its cell arithmetic here.
+    n = lat.shape[0]
+    if n == 0:
+        return np.empty(0, np.int64), np.empty(0, np.float64)
+    lower = threshold_m * 0.99
+    upper = threshold_m * 1.01
+    phi = np.radians(lat)
+    lam = np.radians(lon)
+    keep = np.empty(n, np.int64)
+    bearings = np.empty(n, np.float64)
+    keep[0] = 0
+    bearings[0] = np.nan
+    count = 1
+    last_phi = phi[0]
+    last_lam = lam[0]
+    sin_last = math.sin(last_phi)
+    cos_last = math.cos(last_phi)
+    for i in range(1, n):
+        d_phi = phi[i] - last_phi
+        d_lambda = lam[i] - last_lam
+        dx = d_lambda
+        if dx > math.pi:
+            dx -= 2 * math.pi
+        elif dx < -math.pi:
+            dx += 2 * math.pi
+        dx *= cos_last
+        approx = EARTH_RADIUS_M * math.sqrt(dx * dx + d_phi * d_phi)
+        if approx < lower:
+            continue
+        cos_phi = math.cos(phi[i])
+        if approx <= upper:
+            a = math.sin(d_phi / 2) ** 2 + cos_last * cos_phi * math.sin(d_lambda / 2) ** 2
+            if EARTH_RADIUS_M * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a)) < threshold_m:
+                continue
+        sin_phi = math.sin(phi[i])
+        x = math.sin(d_lambda) * cos_phi
+        y = cos_last * sin_phi - sin_last * cos_phi * math.cos(d_lambda)
+        keep[count] = i
+        bearings[count] = (math.degrees(math.atan2(x, y)) + 360) % 360
+        count += 1
+        last_phi = phi[i]
+        last_lam = lam[i]
+        sin_last = sin_phi
+        cos_last = cos_phi
+    return keep[:count], bearings[:count]
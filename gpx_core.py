@@ -0,0 +1,158 @@
+import io
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+from lxml import etree
+from geo_kernel import filter_kernel
+
+# --- Helper Functions ---
+THRESHOLD_FT = 13
+THRESHOLD_M = THRESHOLD_FT * 0.3048
+DEFAULT_FRAME_ID = -2147483648
+CSV_CHUNK_ROWS = 65536
+CONVERTED_FIELDS = ['trkpt_id', 'frame_latitude', 'frame_longitude', 'frame_time']
+FILTERED_FIELDS = CONVERTED_FIELDS + ['frame_id', 'direction', 'cardinal_direction']
+DIRECTIONS = ('N', 'NE', 'E', 'SE', 'S', 'SW', 'W', 'NW')
+# Lookup tables indexed by direction bucket; the extra trailing entry is the
+# blank used for the first kept point, which has no bearing.
+_DIRECTION_TABLE = np.array(DIRECTIONS + ('',), dtype='<U2')
+_CARDINAL_TABLE = np.array([d[0] for d in DIRECTIONS] + [''], dtype='<U1')
+
+def format_gpx_time(text):
+    text = text.strip()
+    try:
+        time = datetime.fromisoformat(text)
+    except ValueError:
+        return ''
+    # isoformat() is the expensive half. For the usual UTC stamp already laid
+    # out as YYYY-MM-DDTHH:MM:SS[.f]Z only the suffix needs rewriting.
+    if (text[-1:] == 'Z' and len(text) >= 20 and text[19] in '.Z' and text[10] == 'T'
+            and text[4] == text[7] == '-' and text[13] == text[16] == ':'):
+        if time.microsecond:
+            return f"{text[:19]}.{time.microsecond:06d}+00:00"
+        return text[:19] + '+00:00'
+    return time.isoformat()
+
+def iter_trkpts(source):
+    # Only <trkpt> end events are reported; each point is cleared and dropped
+    # from its parent once read, so the parsed tree never grows.
+    try:
+        for _, elem in etree.iterparse(source, events=('end',), tag='{*}trkpt', resolve_entities=False):
+            time = elem.findtext('{*}time')
+            yield (
+                float(elem.get('lat')),
+                float(elem.get('lon')),
+                format_gpx_time(time) if time else ''
+            )
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+    except etree.LxmlError as e:
+        # lxml errors carry an error log that cannot be pickled back from a
+        # worker process, which would hide the actual parse error.
+        raise ValueError(str(e)) from None
+
+def convert_gpx_to_df(data):
+    # Every <trkpt> start tag contains one of these, so the count is an upper
+    # bound on the number of points and the columns never need to grow.
+    capacity = data.count(b'<trkpt') + data.count(b':trkpt')
+    lats = np.empty(capacity, dtype=np.float64)
+    lons = np.empty(capacity, dtype=np.float64)
+    times = [''] * capacity
+    n = 0
+    for lat, lon, time in iter_trkpts(io.BytesIO(data)):
+        lats[n] = lat
+        lons[n] = lon
+        times[n] = time
+        n += 1
+
+    return pd.DataFrame({
+        'trkpt_id': np.arange(n),
+        'frame_latitude': lats[:n],
+        'frame_longitude': lons[:n],
+        'frame_time': times[:n]
+    })
+
+def filter_df(df):
+    lat = df['frame_latitude'].to_numpy(dtype=np.float64)
+    lon = df['frame_longitude'].to_numpy(dtype=np.float64)
+    keep, bearings = filter_kernel(lat, lon, THRESHOLD_M)
+    index = np.full(len(keep), len(DIRECTIONS), dtype=np.int64)
+    index[1:] = ((bearings[1:] + 22.5) // 45).astype(np.int64) % 8
+
+    filtered = df.iloc[keep].reset_index(drop=True)
+    filtered['frame_id'] = DEFAULT_FRAME_ID
+    filtered['direction'] = _DIRECTION_TABLE[index]
+    filtered['cardinal_direction'] = _CARDINAL_TABLE[index]
+    return filtered
+
+def write_csv(df, fieldnames):
+    # Columns missing from an uploaded CSV are written blank, as DictWriter did.
+    df = df.reindex(columns=fieldnames, fill_value='')
+    # Floats are written with repr() and rows end in CRLF, as csv.writer did.
+    for name in fieldnames:
+        if pd.api.types.is_float_dtype(df[name]):
+            df[name] = list(map(repr, df[name].tolist()))
+    output = io.BytesIO()
+    output.write((','.join(fieldnames) + '\n').encode("utf-8"))
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    options = pa_csv.WriteOptions(include_header=False, batch_size=CSV_CHUNK_ROWS, quoting_style='none')
+    try:
+        pa_csv.write_csv(table, output, options)
+    except pa.ArrowInvalid:
+        # A value contains a delimiter, quote or newline; let pandas quote it.
+        output = io.BytesIO()
+        df.to_csv(output, index=False, lineterminator='\r\n', encoding="utf-8")
+        return output.getvalue()
+    # pyarrow only writes LF, and unquoted values cannot contain a newline.
+    return output.getvalue().replace(b'\n', b'\r\n')
+
+# --- Pipelines ---
+# Bytes in, bytes out, so they can be cached by Streamlit and sent to worker
+# processes.
+def gpx_bytes_to_csv(data):
+    return write_csv(convert_gpx_to_df(data), CONVERTED_FIELDS)
+
+def filter_csv_bytes(data):
+    df = pd.read_csv(io.BytesIO(data), encoding='utf-8', dtype=str, keep_default_na=False)
+    return write_csv(filter_df(df), FILTERED_FIELDS)
+
+def gpx_bytes_to_filtered_csv(data):
+    return write_csv(filter_df(convert_gpx_to_df(data)), FILTERED_FIELDS)
+
+# --- EXIF Helpers ---
+def decimal_to_dms(decimal):
+    # Work in hundredths of an arcsecond so the split is exact integer math.
+    total = int(round(abs(decimal) * 360000))
+    degrees, rest = divmod(total, 360000)
+    minutes, seconds = divmod(rest, 6000)
+    return [(degrees, 1), (minutes, 1), (seconds, 100)]
+
+def create_gps_exif(lat, lon):
+    # piexif is only needed by the frame extraction tab
+    import piexif
+
+    gps_ifd = {
+        piexif.GPSIFD.GPSLatitudeRef: 'N' if lat >= 0 else 'S',
+        piexif.GPSIFD.GPSLatitude: decimal_to_dms(lat),
+        piexif.GPSIFD.GPSLongitudeRef: 'E' if lon >= 0 else 'W',
+        piexif.GPSIFD.GPSLongitude: decimal_to_dms(lon),
+    }
+    exif_dict = {"GPS": gps_ifd}
+    return piexif.dump(exif_dict)
+
+def save_frame(frame, image_path, lat, lon):
+    # Runs on a worker thread; OpenCV releases the GIL while encoding. The
+    # EXIF block is inserted in memory so each JPEG is written to disk once.
+    import cv2
+    import piexif
+
+    ok, jpeg = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 100])
+    if not ok:
+        raise ValueError("JPEG encoding failed")
+    output = io.BytesIO()
+    piexif.insert(create_gps_exif(float(lat), float(lon)), jpeg.tobytes(), output)
+    with open(image_path, 'wb') as f:
+        f.write(output.getvalue())
@@ -1,10 +1,10 @@
 import streamlit as st
-import gpxpy
-import gpxpy.gpx
-import csv
-import io
 import os
-import math
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from gpx_core import gpx_bytes_to_csv, filter_csv_bytes, gpx_bytes_to_filtered_csv, save_frame
 
 # --- Set Page Config ---
 st.set_page_config(
@@ -15,93 +15,94 @@ st.set_page_config(
 
 st.title("🗂️ Transconomy Utility App")
 
-# --- Helper Functions ---
-THRESHOLD_FT = 13
-THRESHOLD_M = THRESHOLD_FT * 0.3048
-DEFAULT_FRAME_ID = -2147483648
-
-def haversine(lat1, lon1, lat2, lon2):
-    R = 6371000
-    phi1 = math.radians(lat1)
-    phi2 = math.radians(lat2)
-    d_phi = math.radians(lat2 - lat1)
-    d_lambda = math.radians(lon2 - lon1)
-    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    return R * c
-
-def calculate_bearing(lat1, lon1, lat2, lon2):
-    dLon = math.radians(lon2 - lon1)
-    lat1 = math.radians(lat1)
-    lat2 = math.radians(lat2)
-    x = math.sin(dLon) * math.cos(lat2)
-    y = math.cos(lat1) * math.sin(lat2) - (math.sin(lat1) * math.cos(lat2) * math.cos(dLon))
-    bearing = math.atan2(x, y)
-    return (math.degrees(bearing) + 360) % 360
-
-def get_direction(bearing):
-    directions = ['N', 'NE', 'E', 'SE', 'S', 'SW', 'W', 'NW']
-    index = int((bearing + 22.5) // 45) % 8
-    return directions[index]
-
-def convert_gpx_to_rows(uploaded_file):
-    file_content = uploaded_file.read().decode("utf-8")
-    gpx = gpxpy.parse(io.StringIO(file_content))
-
-    rows = []
-    trkpt_id = 0
-    for track in gpx.tracks:
-        for segment in track.segments:
-            for point in segment.points:
-                rows.append({
-                    'trkpt_id': trkpt_id,
-                    'frame_latitude': point.latitude,
-                    'frame_longitude': point.longitude,
-                    'frame_time': point.time.isoformat() if point.time else ''
-                })
-                trkpt_id += 1
-    return rows
-
-def filter_rows(rows):
-    filtered_rows = []
-
-    first = rows[0]
-    last_lat = float(first['frame_latitude'])
-    last_lon = float(first['frame_longitude'])
-
-    filtered_rows.append({
-        **first,
-        'frame_id': DEFAULT_FRAME_ID,
-        'direction': '',
-        'cardinal_direction': ''
-    })
-
-    for point in rows[1:]:
-        lat = float(point['frame_latitude'])
-        lon = float(point['frame_longitude'])
-
-        distance = haversine(last_lat, last_lon, lat, lon)
-        if distance >= THRESHOLD_M:
-            bearing = calculate_bearing(last_lat, last_lon, lat, lon)
-            direction = get_direction(bearing)
-            cardinal = direction[0] if direction else ''
-            filtered_rows.append({
-                **point,
-                'frame_id': DEFAULT_FRAME_ID,
-                'direction': direction,
-                'cardinal_direction': cardinal
-            })
-            last_lat, last_lon = lat, lon
-
-    return filtered_rows
-
-def write_csv(data, fieldnames):
-    output = io.StringIO()
-    writer = csv.DictWriter(output, fieldnames=fieldnames)
-    writer.writeheader()
-    writer.writerows(data)
-    output.seek(0)
-    return output.getvalue().encode("utf-8")
+# --- Cached Pipelines ---
+# Streamlit reruns the whole script on every interaction; these are keyed on
+# the uploaded bytes so unchanged uploads are not reprocessed.
+@st.cache_resource
+def _get_executor():
+    # Workers are not forked from the multithreaded server. They import this
+    # script as __mp_main__, where Streamlit calls are no-ops and no widget
+    # has a value, so only the imports do any work.
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+    return ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=context)
+
+# Futures are cached per file content, so reruns reuse finished results and
+# adding a file to a batch only submits the new one. A future that failed is
+# not reused; the next rerun submits that file again.
+@st.cache_resource(show_spinner=False, max_entries=32)
+def _gpx_file_slot(data, filtered):
+    return {}
+
+def _submit_gpx_file(data, filtered):
+    slot = _gpx_file_slot(data, filtered)
+    future = slot.get('future')
+    if future is None or (future.done() and future.exception() is not None):
+        process = gpx_bytes_to_filtered_csv if filtered else gpx_bytes_to_csv
+        executor = _get_executor()
+        try:
+            future = executor.submit(process, data)
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for memory) and took the pool with it.
+            executor.shutdown(wait=False)
+            _get_executor.clear()
+            future = _get_executor().submit(process, data)
+        slot['future'] = future
+    return future
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _filter_csv_bytes(data):
+    return filter_csv_bytes(data)
+
+# --- Shared UI ---
+def _show_gpx_downloads(uploaded_files, filtered):
+    # Every file is submitted before any result is awaited; a failed submit is
+    # reported against its own file like any other error.
+    futures = []
+    for uploaded_file in uploaded_files:
+        try:
+            future = _submit_gpx_file(uploaded_file.getvalue(), filtered)
+        except Exception as e:
+            future = Future()
+            future.set_exception(e)
+        futures.append(future)
+
+    for uploaded_file, future in zip(uploaded_files, futures):
+        try:
+            csv_bytes = future.result()
+        except Exception as e:
+            st.error(f"❌ Error processing `{uploaded_file.name}`: {str(e)}")
+            continue
+
+        original_filename = os.path.splitext(uploaded_file.name)[0]
+        if filtered:
+            filename = f"{original_filename} Metadata.csv"  # Same as CSV Filtration pattern
+            st.success(f"✅ One-step CSV ready: {filename}")
+            label = f"Download Filtered CSV for {uploaded_file.name}"
+        else:
+            filename = original_filename + ".csv"
+            st.success(f"✅ CSV file is ready: {filename}")
+            label = f"Download CSV for {uploaded_file.name}"
+
+        st.download_button(
+            label=label,
+            data=csv_bytes,
+            file_name=filename,
+            mime="text/csv"
+        )
+
+def _report_saved_frames(pending, limit):
+    # Pops saves that have finished, or the oldest ones while more than
+    # `limit` are queued, and reports their errors. Returns how many popped.
+    finished = 0
+    while pending and (pending[0][2].done() or len(pending) > limit):
+        _, index, future = pending.popleft()
+        try:
+            future.result()
+        except Exception as e:
+            st.error(f"❌ Error at index {index}: {str(e)}")
+        finished += 1
+    return finished
 
 # --- Tabs ---
 tab1, tab2, tab3, tab4 = st.tabs([
@@ -118,21 +119,7 @@ with tab1:
     uploaded_files = st.file_uploader("Upload GPX files", type="gpx", accept_multiple_files=True)
 
     if uploaded_files:
-        for uploaded_file in uploaded_files:
-            try:
-                rows = convert_gpx_to_rows(uploaded_file)
-                fieldnames = ['trkpt_id', 'frame_latitude', 'frame_longitude', 'frame_time']
-                csv_bytes = write_csv(rows, fieldnames)
-                filename = os.path.splitext(uploaded_file.name)[0] + ".csv"
-                st.success(f"✅ CSV file is ready: {filename}")
-                st.download_button(
-                    label=f"Download CSV for {uploaded_file.name}",
-                    data=csv_bytes,
-                    file_name=filename,
-                    mime="text/csv"
-                )
-            except Exception as e:
-                st.error(f"❌ Error processing `{uploaded_file.name}`: {str(e)}")
+        _show_gpx_downloads(uploaded_files, filtered=False)
 
 # --- CSV Filtration ---
 with tab2:
@@ -141,14 +128,7 @@ with tab2:
 
     if uploaded_csv:
         try:
-            csv_data = uploaded_csv.read().decode('utf-8')
-            csv_lines = csv_data.splitlines()
-            reader = csv.DictReader(csv_lines)
-            rows = list(reader)
-
-            filtered = filter_rows(rows)
-            fieldnames = ['trkpt_id', 'frame_latitude', 'frame_longitude', 'frame_time', 'frame_id', 'direction', 'cardinal_direction']
-            csv_bytes = write_csv(filtered, fieldnames)
+            csv_bytes = _filter_csv_bytes(uploaded_csv.getvalue())
             filename = os.path.splitext(uploaded_csv.name)[0] + " Metadata.csv"
 
             st.success(f"✅ Filtered CSV is ready: {filename}")
@@ -167,42 +147,22 @@ with tab3:
     uploaded_files = st.file_uploader("Upload GPX files", type="gpx", accept_multiple_files=True, key="one_step")
 
     if uploaded_files:
-        for uploaded_file in uploaded_files:
-            try:
-                # Step 1: Convert GPX to rows
-                rows = convert_gpx_to_rows(uploaded_file)
-
-                # Step 2: Filter and add metadata
-                filtered = filter_rows(rows)
-
-                # Step 3: Write to CSV
-                fieldnames = ['trkpt_id', 'frame_latitude', 'frame_longitude', 'frame_time', 'frame_id', 'direction', 'cardinal_direction']
-                csv_bytes = write_csv(filtered, fieldnames)
-
-                # Output filename similar to CSV Filtration
-                original_filename = os.path.splitext(uploaded_file.name)[0]
-                output_filename = f"{original_filename} Metadata.csv"  # Same as CSV Filtration pattern
-
-                st.success(f"✅ One-step CSV ready: {output_filename}")
-                st.download_button(
-                    label=f"Download Filtered CSV for {uploaded_file.name}",
-                    data=csv_bytes,
-                    file_name=output_filename,
-                    mime="text/csv"
-                )
-            except Exception as e:
-                st.error(f"❌ Error processing `{uploaded_file.name}`: {str(e)}")
+        # Convert, filter and write to CSV in one cached step
+        _show_gpx_downloads(uploaded_files, filtered=True)
+
 with tab4:
     st.title("Extract Frames & Embed GPS")
 
     video_file = st.file_uploader("Upload Video File (MP4)", type=["mp4"], key="video_file")
     metadata_file = st.file_uploader("Upload Metadata CSV", type=["csv"], key="metadata_file")
 
-    if video_file and metadata_file:
+    # Extraction writes every frame to disk, so it only runs on an explicit
+    # click rather than on every rerun triggered elsewhere in the app.
+    if video_file and metadata_file and st.button("Extract Frames", key="extract_frames"):
         try:
+            import shutil
             import tempfile
             import cv2
-            import piexif
             from fractions import Fraction
             from datetime import datetime
             import pandas as pd
@@ -211,17 +171,11 @@ with tab4:
 
             # Save temp video file
             with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as tmp_video:
-                tmp_video.write(video_file.read())
+                shutil.copyfileobj(video_file, tmp_video, length=1024 * 1024)
                 tmp_video_path = tmp_video.name
 
-            # Save temp CSV file
-            csv_bytes = metadata_file.read()
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".csv") as tmp_csv:
-                tmp_csv.write(csv_bytes)
-                tmp_csv_path = tmp_csv.name
-
-            # Load CSV
-            df = pd.read_csv(tmp_csv_path)
+            # Load CSV straight from the upload; only OpenCV needs a real file
+            df = pd.read_csv(metadata_file)
             video = cv2.VideoCapture(tmp_video_path)
             fps = video.get(cv2.CAP_PROP_FPS)
 
@@ -230,59 +184,88 @@ with tab4:
             output_folder = os.path.join(os.getcwd(), f"{video_name}_frames")
             os.makedirs(output_folder, exist_ok=True)
 
-            # Helper functions
-            def decimal_to_dms(decimal):
-                degrees = int(abs(decimal))
-                minutes = int((abs(decimal) - degrees) * 60)
-                seconds = (abs(decimal) - degrees - minutes / 60) * 3600
-                return [(degrees, 1), (minutes, 1), (int(seconds * 100), 100)]
-
-            def create_gps_exif(lat, lon):
-                gps_ifd = {
-                    piexif.GPSIFD.GPSLatitudeRef: 'N' if lat >= 0 else 'S',
-                    piexif.GPSIFD.GPSLatitude: decimal_to_dms(lat),
-                    piexif.GPSIFD.GPSLongitudeRef: 'E' if lon >= 0 else 'W',
-                    piexif.GPSIFD.GPSLongitude: decimal_to_dms(lon),
-                }
-                exif_dict = {"GPS": gps_ifd}
-                return piexif.dump(exif_dict)
-
             st.info("Starting frame extraction...")
             progress_bar = st.progress(0)
             total = len(df)
 
-            for index, row in df.iterrows():
+            # Work out each row's frame number first, then decode the video in
+            # one forward pass: frames between targets are only grabbed, never
+            # converted, and there is no per-row seek back to a keyframe.
+            targets = []
+            done = 0
+            frame_times = df['frame_time'].tolist()
+            start_time = None
+            rows = zip(df.index, frame_times, df['frame_latitude'].tolist(), df['frame_longitude'].tolist())
+            for index, frame_time, lat, lon in rows:
                 try:
-                    timestamp = datetime.fromisoformat(row['frame_time'])
-                    start_time = datetime.fromisoformat(df['frame_time'].iloc[0])
+                    timestamp = datetime.fromisoformat(frame_time)
+                    # Parsed once, on first use; a bad first time is then
+                    # reported against every row, as before.
+                    if start_time is None:
+                        start_time = datetime.fromisoformat(frame_times[0])
                     time_diff = (timestamp - start_time).total_seconds()
-                    frame_no = int(time_diff * fps)
-
-                    video.set(cv2.CAP_PROP_POS_FRAMES, frame_no)
-                    success, frame = video.read()
-
-                    if not success:
-                        st.warning(f"⚠️ Skipped frame at {time_diff:.2f}s (index {index})")
-                        continue
-
-                    image_filename = f"{video_name}_{frame_no}.jpg"
-                    image_path = os.path.join(output_folder, image_filename)
-
-                    # Save image
-                    cv2.imwrite(image_path, frame, [int(cv2.IMWRITE_JPEG_QUALITY), 100])
-
-                    # Embed GPS
-                    lat = float(row['frame_latitude'])
-                    lon = float(row['frame_longitude'])
-                    exif_bytes = create_gps_exif(lat, lon)
-                    piexif.insert(exif_bytes, image_path)
-
+                    targets.append((int(time_diff * fps), index, time_diff, lat, lon))
                 except Exception as e:
                     st.error(f"❌ Error at index {index}: {str(e)}")
+                    done += 1
+                    progress_bar.progress(done / total)
+
+            targets.sort(key=lambda target: target[0])
+            position = -1
+            grabbed = True
+            retrieved_no = None
+            # JPEG encoding and EXIF insertion run on worker threads while the
+            # main thread keeps decoding; the queue caps how many decoded frames
+            # are held at once.
+            workers = os.cpu_count() or 1
+            pending = deque()
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for frame_no, index, time_diff, lat, lon in targets:
+                    done += _report_saved_frames(pending, limit=2 * workers)
+                    progress_bar.progress(done / total)
+                    try:
+                        # Once past the last retrieved frame it is only held by
+                        # its pending save, so drop it before decoding further.
+                        if retrieved_no is not None and retrieved_no != frame_no:
+                            frame = retrieved_no = None
+
+                        while grabbed and position < frame_no:
+                            grabbed = video.grab()
+                            position += 1
+
+                        if grabbed and position == frame_no and retrieved_no != frame_no:
+                            success, frame = video.retrieve()
+                            retrieved_no = frame_no if success else None
+                        success = retrieved_no == frame_no
+
+                        if not success:
+                            st.warning(f"⚠️ Skipped frame at {time_diff:.2f}s (index {index})")
+                            done += 1
+                            continue
+
+                        image_filename = f"{video_name}_{frame_no}.jpg"
+                        image_path = os.path.join(output_folder, image_filename)
+
+                        # Rows sharing a frame write the same file, so wait for
+                        # the previous row's save before starting this one.
+                        if pending and pending[-1][0] == frame_no:
+                            wait([pending[-1][2]])
+
+                        future = pool.submit(save_frame, frame, image_path, lat, lon)
+                        pending.append((frame_no, index, future))
+
+                    except Exception as e:
+                        st.error(f"❌ Error at index {index}: {str(e)}")
+                        done += 1
+
+                # Nothing else needs decoding, so free the decoder while the
+                # last saves finish.
+                frame = None
+                video.release()
+                done += _report_saved_frames(pending, limit=0)
+                if total:
+                    progress_bar.progress(done / total)
 
-                progress_bar.progress((index + 1) / total)
-
-            video.release()
             st.success(f"🎉 Done! Extracted frames saved to: `{output_folder}`")
             st.info("Download frames manually from your working directory.")
 